@@ -3,18 +3,39 @@ import torchvision
 import torch.nn.functional as F
 import torch
 
+try:
+    from apex.normalization import FusedLayerNorm
+except ImportError:
+    FusedLayerNorm = None
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+def replace_layer_norm(container: nn.Module) -> nn.Module:
+    # Swap nn.LayerNorm for apex's fused kernel, keeping the pretrained affine parameters.
+    # LayerNorm2d subclasses nn.LayerNorm but permutes NCHW itself, so only exact matches are replaced.
+    for child_name, child in container.named_children():
+        if type(child) is nn.LayerNorm:
+            fused = FusedLayerNorm(child.normalized_shape, eps=child.eps,
+                                   elementwise_affine=child.elementwise_affine)
+            fused.load_state_dict(child.state_dict())
+            setattr(container, child_name, fused)
+        else:
+            replace_layer_norm(child)
+    return container
+
 class ConvNextGP(nn.Module):
     def __init__(self, num_classes: int):
         super(ConvNextGP, self).__init__()
         self.feature_extractor = torchvision.models.convnext_tiny(weights="ConvNeXt_Tiny_Weights.DEFAULT").to(device) # 768
         #self.feature_extractor = torchvision.models.convnext_base(weights="ConvNeXt_Base_Weights.DEFAULT").to(device) # 1024
+        if FusedLayerNorm is not None:
+            self.feature_extractor = replace_layer_norm(self.feature_extractor)
         for param in self.feature_extractor.parameters():
             param.requires_grad = False
         # Replace the classifier with nn.Identity to keep the features unchanged
         self.feature_extractor.classifier = nn.Identity()
-        self.flatten = nn.Flatten(start_dim=1, end_dim=-1)
+        # NHWC lets cuDNN pick the tensor-core conv kernels
+        self.feature_extractor = self.feature_extractor.to(device, memory_format=torch.channels_last)
         self.num_classes = num_classes
 
         if self.num_classes is not None:
@@ -22,20 +43,14 @@ class ConvNextGP(nn.Module):
         else:
             self.classifier = None
 
-    def forward(self, x, **kwargs):
-        features = self.feature_extractor(x)
-        features = self.flatten(features)
+    def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=x.is_cuda):
+            features = self.feature_extractor(x)
+        features = features.float().flatten(1)
         if self.classifier is None:
             return features
-
-        logits = self.classifier(features)
-
-        if isinstance(logits, tuple):
-            logits, uncertainty = logits
-            prob = F.log_softmax(logits, dim=1)
-            return prob, uncertainty
-        else:
-            return F.log_softmax(logits, dim=1)
+        return F.log_softmax(self.classifier(features), dim=1)
 
 class EfficientNetGP(nn.Module):
     def __init__(self, num_classes: int):
@@ -129,18 +144,23 @@ class SimpleMLP(nn.Module):
         self.fc2 = nn.Linear(256, 128)
         self.dropout = nn.Dropout(0.1)  # for cifar10
         # self.dropout = nn.Dropout(0.3)
-        self.prelu = nn.PReLU()
+        self.prelu1 = nn.PReLU()
+        self.prelu2 = nn.PReLU()
         if self.num_classes is not None:
             self.classifier = nn.Linear(128, num_classes)
 
-    def forward(self, x, kwargs={}):
-        x = x.view(x.size(0), -1)
-        x = self.prelu(self.fc1(x))
+    def forward(self, x, kwargs=None):
+        x = x.flatten(1)
+        x = self.prelu1(self.fc1(x))
         x = self.dropout(x)
-        x = self.prelu(self.fc2(x))
+        x = self.prelu2(self.fc2(x))
         x = self.dropout(x)
         if self.num_classes is not None:
-            x = self.classifier(x, **kwargs)
+            # The head may be the SNGP random-feature GP, whose features and precision update must stay in fp32
+            with torch.autocast(device_type=x.device.type, enabled=False):
+                x = x.float()
+                # kwargs are only meaningful once replace_layer_with_gaussian swaps in the SNGP head
+                x = self.classifier(x, **kwargs) if kwargs else self.classifier(x)
         return x
     # #
     #     super(SimpleMLP, self).__init__()
@@ -181,7 +201,7 @@ class SimpleConvNet(nn.Module):
         x = x.view(x.size(0), 1, 32, 24)  # Reshape to (batch_size, 1, 32, 24)
         x = F.relu(self.conv1(x))
         x = F.relu(self.conv2(x))
-        x = x.view(x.size(0), -1)  # Flatten the tensor
+        x = x.flatten(1)  # Flatten the tensor
         x = self.prelu(self.fc1(x))
         if self.num_classes is not None:
             x = self.classifier(x, **kwargs)
@@ -130,4 +130,6 @@ class DKL(gpytorch.Module):
 
     def forward(self, x):
         features = self.feature_extractor(x)
-        return self.gp(features)
+        # The GP kernel and its solves are fragile in reduced precision, so keep them in fp32 under autocast
+        with torch.autocast(device_type=features.device.type, enabled=False):
+            return self.gp(features.float())
@@ -12,6 +12,12 @@ from torch.utils.data import Subset
 from sngp_wrapper.covert_utils import convert_to_sn_my
 import clip
 
+try:
+    from nvidia.dali import fn, pipeline_def, types
+    from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+except ImportError:
+    pipeline_def = None
+
 IMAGENET_CONVNEXT_MEAN = [0.485, 0.456, 0.406]
 IMAGENET_CONVNEXT_STD = [0.229, 0.224, 0.225]
 
@@ -105,11 +111,15 @@ class ImageFolderWithPaths(torchvision.datasets.ImageFolder):
         path = self.imgs[index][0]
         return img, label, path
 
-def retrieve_model(model_name):
+def retrieve_model(model_name, compile=False):
     # spec_norm_replace_list = ["Linear", "Conv2D"]
     # coeff = 0.95
     if model_name == "convnext":
         model = ConvNextGP(num_classes=None).cuda()
+        if compile:
+            # Frozen backbone at a fixed 224x224 input: a static graph that CUDA graphs can replay.
+            # With apex's FusedLayerNorm swapped in, dynamo breaks the graph at every block's LayerNorm.
+            model.feature_extractor.compile(mode="reduce-overhead", fullgraph=False)
     else:
         model, _ = clip.load("ViT-L/14@336px", device=torch.device("cuda"))
     # Constraint SN
@@ -124,7 +134,7 @@ def save_features(model, dataloader, output_dir, dataset_name):
     with torch.no_grad():
         if dataset_name == "Brain_tumors" or dataset_name == "Alzheimer":
             for inputs, labels, paths in tqdm(dataloader):
-                inputs = inputs.cuda()
+                inputs = inputs.cuda(non_blocking=True)
                 # hasattr(object, attribute) : returns True if the object has the given attribute, otherwise False
                 if hasattr(model, "encode_image"):
                     features = model.encode_image(inputs)
@@ -140,7 +150,7 @@ def save_features(model, dataloader, output_dir, dataset_name):
 
         elif dataset_name in {"CIFAR10", "SVHN", "Colorectal_cancer", "Breast_cancer"}:
             for index, (input, label) in enumerate(tqdm(dataloader)):
-                input = input.cuda()
+                input = input.cuda(non_blocking=True)
                 features = model(input)
                 representations.append(features.cpu())
                 labels.append(label.cpu())
@@ -151,10 +161,40 @@ def save_features(model, dataloader, output_dir, dataset_name):
         else:
             raise ValueError("Unknown dataset")
 
-def process_dataset(get_dataset_func, model, output_dir, dataset_name):
+def dali_loader(samples, batch_size, num_workers):
+    # GPU image decoding with a resize/crop/normalize close to TRANSFORMS; DALI's resize and fp16
+    # normalization are not bit-identical to torchvision, so features differ slightly from the default path
+    files, labels = map(list, zip(*samples))
+
+    @pipeline_def(batch_size=batch_size, num_threads=num_workers, device_id=torch.cuda.current_device())
+    def image_pipeline():
+        encoded, targets = fn.readers.file(files=files, labels=labels, random_shuffle=False, name="Reader")
+        images = fn.decoders.image(encoded, device="mixed", output_type=types.RGB)
+        images = fn.resize(images, resize_shorter=232, interp_type=types.INTERP_LINEAR)
+        images = fn.crop_mirror_normalize(images, crop=(224, 224), dtype=types.FLOAT16, output_layout="HWC",
+                                          mean=[255 * m for m in IMAGENET_CONVNEXT_MEAN],
+                                          std=[255 * s for s in IMAGENET_CONVNEXT_STD])
+        return images, targets.gpu()
+
+    pipe = image_pipeline()
+    pipe.build()
+    iterator = DALIGenericIterator(pipe, ["data", "label"], reader_name="Reader",
+                                   last_batch_policy=LastBatchPolicy.PARTIAL)
+    for batch in iterator:
+        # NHWC -> NCHW view with channels_last strides, no copy
+        yield batch[0]["data"].permute(0, 3, 1, 2), batch[0]["label"].squeeze(-1).long()
+
+def process_dataset(get_dataset_func, model, output_dir, dataset_name, use_dali=False):
     train_dataset, test_dataset = get_dataset_func()
-    train_loader = DataLoader(train_dataset, batch_size=64, shuffle=False, num_workers=4, pin_memory=True)
-    test_loader = DataLoader(test_dataset, batch_size=64, shuffle=False, num_workers=4, pin_memory=True)
+    if use_dali and pipeline_def is None:
+        raise ImportError("use_dali=True requires nvidia-dali to be installed")
+    if use_dali and isinstance(train_dataset, Subset):
+        # ImageFolder splits are encoded image files on disk, which DALI can decode on the GPU
+        train_loader = dali_loader([train_dataset.dataset.samples[i] for i in train_dataset.indices], batch_size=64, num_workers=4)
+        test_loader = dali_loader([test_dataset.dataset.samples[i] for i in test_dataset.indices], batch_size=64, num_workers=4)
+    else:
+        train_loader = DataLoader(train_dataset, batch_size=64, shuffle=False, num_workers=4, pin_memory=True)
+        test_loader = DataLoader(test_dataset, batch_size=64, shuffle=False, num_workers=4, pin_memory=True)
     save_features(model, train_loader, os.path.join(output_dir, "train"), dataset_name)
     save_features(model, test_loader, os.path.join(output_dir, "test"), dataset_name)
 
@@ -35,20 +35,41 @@ class FeatureDataset(Dataset):
         label = os.path.basename(os.path.dirname(feature_path))
         return feature, self.label_map[label]
 
+def load_cached_features(feature_dir):
+    # Stacks the per-image .pt files into a single tensor file, so later runs do a
+    # single torch.load instead of one per sample and epoch.
+    cache_path = f"{os.path.normpath(feature_dir)}.pt"
+    full_dataset = FeatureDataset(feature_dir)
+    # Rebuilt whenever a feature file was added, removed or regenerated after the cache was written
+    if os.path.exists(cache_path):
+        latest = max((os.path.getmtime(path) for path in full_dataset.feature_paths), default=0)
+        if os.path.getmtime(cache_path) >= latest:
+            data = torch.load(cache_path)
+            if len(data['labels']) == len(full_dataset):
+                return data['features'], data['labels']
+    samples = [full_dataset[i] for i in range(len(full_dataset))]
+    features = torch.stack([feature for feature, _ in samples])
+    labels = torch.tensor([label for _, label in samples])
+    # Written next to the target and renamed, so concurrent runs never read a half-written cache
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    torch.save({"features": features, "labels": labels}, tmp_path)
+    os.replace(tmp_path, cache_path)
+    return features, labels
+
 def get_tumors_feature(image_path: str = "./data_feature/Brain_tumors"):
-    full_dataset = FeatureDataset(image_path)
+    features, labels = load_cached_features(image_path)
     input_size = 768
     num_classes = 4
-    targets = [full_dataset[i][1] for i in range(len(full_dataset))]
+    targets = labels.tolist()
     train_indices, temp_indices, _, temp_labels = train_test_split(
-        range(len(full_dataset)), targets, test_size=0.2, stratify=targets, random_state=23
+        range(len(targets)), targets, test_size=0.2, stratify=targets, random_state=23
     )
     val_indices, test_indices = train_test_split(
         temp_indices, test_size=0.5, stratify=temp_labels, random_state=23
     )
-    train_dataset = TransformedDataset(Subset(full_dataset, train_indices), transform=None)
-    val_dataset = TransformedDataset(Subset(full_dataset, val_indices), transform=None)
-    test_dataset = TransformedDataset(Subset(full_dataset, test_indices), transform=None)
+    train_dataset = TensorDataset(features[train_indices], labels[train_indices])
+    val_dataset = TensorDataset(features[val_indices], labels[val_indices])
+    test_dataset = TensorDataset(features[test_indices], labels[test_indices])
     return input_size, num_classes, train_dataset, val_dataset, test_dataset
 
 def get_cifar10_or_svhm(image_path: str = "./data_feature/CIFAR10"):
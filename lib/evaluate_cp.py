@@ -19,10 +19,10 @@ class ConformalTrainingLoss(nn.Module):
         self.args = args
 
     def forward(self, probabilities, y):
-        conformity_score = probabilities[torch.arange(len(probabilities)), y]
+        # gather stays on the device; indexing with a fresh CPU arange costs an allocation and a copy every batch
+        conformity_score = probabilities.gather(1, y.unsqueeze(1)).squeeze(1)
         tau = torch.quantile(conformity_score, self.alpha)
         in_set_prob = F.sigmoid((probabilities - tau) / self.temperature)
-        print(f"in set prob: {in_set_prob}")
         if self.args.size_loss_form == 'log':
             size_loss = torch.log( torch.clamp(in_set_prob.sum(dim=1), min=1).mean(dim=0) )
         elif self.args.size_loss_form == 'identity':
@@ -34,52 +34,51 @@ class ConformalTrainingLoss(nn.Module):
         if self.args.sngp or self.args.snn:
             fn_loss = F.cross_entropy(probabilities, y)
             total_loss = fn_loss + size_loss
-            print(f"Total loss : {(size_loss.item() + fn_loss.item()):.4f} | Size loss: {size_loss.item():.4f} | Ce loss : {fn_loss.item():.4f}")
             return total_loss
         else:
-            print(f"size loss : {size_loss.item():.4f}")
             return size_loss
     def compute(self):
         return self.eff
 
 def tps(cal_smx, val_smx, cal_labels, val_labels, n, alpha):
-    cal_scores = 1 - cal_smx[torch.arange(n), cal_labels]
+    cal_scores = 1 - cal_smx.gather(1, cal_labels.unsqueeze(1)).squeeze(1)
     q_level = np.ceil((n + 1) * (1 - alpha)) / n
     q_hat = torch.quantile(cal_scores, q_level, interpolation='midpoint')  # 'higher'
     prediction_sets = val_smx >= (1 - q_hat)
-    coverage = prediction_sets[torch.arange(prediction_sets.shape[0]), val_labels].float().mean()
-    efficiency = torch.sum(prediction_sets) / len(prediction_sets)
-    prediction_sets = prediction_sets.cpu()
-    return prediction_sets.numpy(), coverage.item(), efficiency.item()
+    coverage = prediction_sets.gather(1, val_labels.unsqueeze(1)).float().mean()
+    efficiency = prediction_sets.sum(dim=1).float().mean()
+    # One host sync for both metrics; the prediction sets stay on the device
+    coverage, efficiency = torch.stack([coverage, efficiency]).tolist()
+    return prediction_sets, coverage, efficiency
 
 def adaptive_tps(cal_smx, val_smx, cal_labels, val_labels, n, alpha):
-    cal_smx = cal_smx.cpu().numpy()
-    val_smx = val_smx.cpu().numpy()
-    cal_pi = np.argsort(-cal_smx, axis=1)
-    cal_srt = np.take_along_axis(cal_smx, cal_pi, axis=1).cumsum(axis=1)
-    cal_scores = np.take_along_axis(cal_srt, cal_pi.argsort(axis=1), axis=1)[range(n), cal_labels]
+    # Cumulative mass of the classes ranked above (and including) each class, scattered back to class order
+    cal_srt, cal_pi = cal_smx.sort(dim=1, descending=True)
+    cal_cum = torch.empty_like(cal_smx).scatter_(1, cal_pi, cal_srt.cumsum(dim=1))
+    cal_scores = cal_cum.gather(1, cal_labels.unsqueeze(1)).squeeze(1)
     q_level = np.ceil( (n + 1) * (1 - alpha) ) / n
-    q_hat = np.quantile(cal_scores, q_level, method="midpoint")
-    val_pi = np.argsort(-val_smx, axis=1)
-    val_srt = np.take_along_axis(val_smx, val_pi, axis=1).cumsum(axis=1)
-    prediction_sets = np.take_along_axis(val_srt <= q_hat, val_pi.argsort(axis=1), axis=1)
-    coverage = prediction_sets[np.arange(prediction_sets.shape[0]), val_labels].mean()
-    efficiency = np.sum(prediction_sets) / len(prediction_sets)
+    q_hat = torch.quantile(cal_scores, q_level, interpolation='midpoint')
+    val_srt, val_pi = val_smx.sort(dim=1, descending=True)
+    prediction_sets = torch.empty_like(val_smx, dtype=torch.bool).scatter_(1, val_pi, val_srt.cumsum(dim=1) <= q_hat)
+    coverage = prediction_sets.gather(1, val_labels.unsqueeze(1)).float().mean()
+    efficiency = prediction_sets.sum(dim=1).float().mean()
+    coverage, efficiency = torch.stack([coverage, efficiency]).tolist()
     return prediction_sets, coverage, efficiency
 
 def get_multiple_permutations(permutation_size: int = 500, num_permutations: int = 5, permutation_data_dir: str = None):
     if permutation_data_dir is None:
         raise ValueError("permutation_data_dir must be specified")
-    if not os.path.exists(permutation_data_dir):
-        os.makedirs(permutation_data_dir)
+    os.makedirs(permutation_data_dir, exist_ok=True)
     path_name = os.path.join(permutation_data_dir, f"{permutation_size}_{num_permutations}.npz")
     if not os.path.exists(path_name):
         permutations = [np.random.permutation(permutation_size) for _ in range(num_permutations)]
-        np.savez(path_name, *permutations)
-        return permutations
-    else:
-        data = np.load(path_name)
-        return [data[f'arr_{i}'] for i in range(num_permutations)]
+        # Saved under a per-process name and renamed, so parallel seed runs never load a half-written file
+        tmp_path = f"{path_name}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, *permutations)
+        os.replace(tmp_path, path_name)
+    # Read back even right after writing, so runs racing to create the file all use the one that landed
+    data = np.load(path_name)
+    return [data[f'arr_{i}'] for i in range(num_permutations)]
 
 def conformal_evaluate(model, likelihood, dataset, adaptive_flag, alpha):
     if dataset == 'CIFAR10':
@@ -108,10 +107,10 @@ def conformal_evaluate(model, likelihood, dataset, adaptive_flag, alpha):
     model.eval()
     likelihood.eval() if likelihood is not None else None
     val_prediction_list, val_label_list, test_prediction_list, test_label_list = [], [], [], []
-    with torch.no_grad():
+    # SNGP (likelihood is None) updates its precision matrix in this forward, which must not become an inference tensor
+    with (torch.no_grad() if likelihood is None else torch.inference_mode()):
         for data, target in val_dataloader:
-            data = data.cuda()
-            target = target.cpu()
+            data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
             if likelihood is None:
                 logits = model(data)
                 val_result = F.softmax(logits, dim=1)
@@ -122,11 +121,10 @@ def conformal_evaluate(model, likelihood, dataset, adaptive_flag, alpha):
                     y_pred = model(data).to_data_independent_dist()
                     # likelihood( model(data) ) -> obtain the predictive distribution.
                     output = likelihood(y_pred).probs.mean(0)  # (batch_size, 4)
-                    val_prediction_list.append(output.cpu())
+                    val_prediction_list.append(output)
             val_label_list.append(target)
         for data, target in test_dataloader:
-            data = data.cuda()
-            target = target.cpu()
+            data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
             if likelihood is None:
                 logits = model(data)
                 test_result = F.softmax(logits, dim=1)
@@ -135,12 +133,13 @@ def conformal_evaluate(model, likelihood, dataset, adaptive_flag, alpha):
                 with gpytorch.settings.num_likelihood_samples(32):
                     y_pred = model(data).to_data_independent_dist()
                     output = likelihood(y_pred).probs.mean(0)
-                    test_prediction_list.append(output.cpu())
+                    test_prediction_list.append(output)
             test_label_list.append(target)
         val_prediction_list, test_prediction_list = torch.cat(val_prediction_list, dim=0), torch.cat(test_prediction_list, dim=0)
         val_label_list, test_label_list = torch.cat(val_label_list, dim=0), torch.cat(test_label_list, dim=0)
-        combined_prediction_tensor = torch.cat([val_prediction_list, test_prediction_list], dim=0).cpu()
-        combined_prediction_label = torch.cat([val_label_list, test_label_list], dim=0).cpu()
+        # Kept on the device: the 100 calibration splits below are scored there without host round trips
+        combined_prediction_tensor = torch.cat([val_prediction_list, test_prediction_list], dim=0)
+        combined_prediction_label = torch.cat([val_label_list, test_label_list], dim=0)
         print(f"combined accuracy {torch.argmax(combined_prediction_tensor, dim=1).eq(combined_prediction_label).float().mean().item():.4f}")
         repeated_times = 100
         custom_permutation = get_multiple_permutations(permutation_size=len(combined_prediction_tensor),
@@ -149,9 +148,10 @@ def conformal_evaluate(model, likelihood, dataset, adaptive_flag, alpha):
         coverage_list, ineff_list = [], []
         cal_size = len(val_label_list)
         for i in range(repeated_times):
-            permutation_index = custom_permutation[i]
-            cal_smx, val_smx = combined_prediction_tensor[permutation_index][:cal_size], combined_prediction_tensor[permutation_index][cal_size:]
-            cal_labels, val_labels = combined_prediction_label[permutation_index][:cal_size], combined_prediction_label[permutation_index][cal_size:]
+            permutation_index = torch.as_tensor(custom_permutation[i], device=combined_prediction_tensor.device)
+            permuted_smx, permuted_labels = combined_prediction_tensor[permutation_index], combined_prediction_label[permutation_index]
+            cal_smx, val_smx = permuted_smx[:cal_size], permuted_smx[cal_size:]
+            cal_labels, val_labels = permuted_labels[:cal_size], permuted_labels[cal_size:]
             if adaptive_flag:
                 _, coverage, ineff = adaptive_tps(cal_smx, val_smx, cal_labels, val_labels, cal_size, alpha)
             else:
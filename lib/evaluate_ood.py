@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 import numpy as np
 import torch
 import gpytorch
@@ -30,11 +31,11 @@ def loop_over_dataloader(model, likelihood, dataloader):
     else:
         model.classifier.update_covariance_matrix()
 
-    with torch.no_grad():
+    with torch.inference_mode():
         scores = []
         accuracies = []
         for i, (data, target) in enumerate(dataloader):
-            data, target = data.cuda(), target.cuda()
+            data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
             if likelihood is None:
                 # output: (batch_size, num_of_classes) (64, 4)
                 output, uncertainty = model(data, kwargs={"update_precision_matrix": False,
@@ -77,17 +78,23 @@ def loop_over_dataloader(model, likelihood, dataloader):
     accuracies = np.concatenate(accuracies)
     return scores, accuracies
 
-def get_ood_metrics(in_dataset: object, out_dataset: object, model: object, likelihood: object = None) -> object:
-    _, _, _, val_in_dataset, in_dataset = get_feature_dataset(in_dataset)()
-    _, _, _, val_out_dataset, out_dataset = get_feature_dataset(out_dataset)()
+@lru_cache(maxsize=None)
+def get_ood_dataloader(in_dataset_name, out_dataset_name):
+    # Built once per dataset pair; get_ood_metrics runs every epoch and would otherwise reload both from disk
+    _, _, _, val_in_dataset, in_dataset = get_feature_dataset(in_dataset_name)()
+    _, _, _, val_out_dataset, out_dataset = get_feature_dataset(out_dataset_name)()
     in_dataset = ConcatDataset([val_in_dataset, in_dataset])
     out_dataset = ConcatDataset([val_out_dataset, out_dataset])
 
     dataloader, anomaly_targets = prepare_ood_datasets(in_dataset, out_dataset)
+    return dataloader, anomaly_targets, len(in_dataset)
+
+def get_ood_metrics(in_dataset: object, out_dataset: object, model: object, likelihood: object = None) -> object:
+    dataloader, anomaly_targets, num_in_samples = get_ood_dataloader(in_dataset, out_dataset)
 
     scores, accuracies = loop_over_dataloader(model, likelihood, dataloader)
 
-    accuracy = np.mean(accuracies[:len(in_dataset)])
+    accuracy = np.mean(accuracies[:num_in_samples])
     assert len(anomaly_targets) == len(scores), "Mismatch in lengths of anomaly_targets and scores"
     auroc = roc_auc_score(anomaly_targets, scores)
     precision, recall, _ = precision_recall_curve(anomaly_targets, scores)
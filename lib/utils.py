@@ -3,7 +3,9 @@ import json
 import pathlib
 from pathlib import Path
 import random
+import copy
 import torch
+import torch.multiprocessing as mp
 import numpy as np
 import matplotlib.pyplot as plt
 import os
@@ -30,9 +32,15 @@ def repeat_experiment(args, seeds, main_fn):
 
     parent_name = "results_conformal" if args.conformal_training else "results_normal"
     start_time = time.time()
-    for seed in seeds:
-        set_seed(seed)
-        one_result = main_fn(args)
+    num_gpus = torch.cuda.device_count()
+    if num_gpus > 1 and len(seeds) > 1:
+        results = run_seeds_in_parallel(args, seeds, main_fn, num_gpus)
+    else:
+        results = []
+        for seed in seeds:
+            set_seed(seed, deterministic=args.deterministic)
+            results.append(main_fn(args))
+    for one_result in results:
         for k, v in one_result.items():
             result_dict[k].append(v)
     end_time = time.time()
@@ -54,17 +62,38 @@ def repeat_experiment(args, seeds, main_fn):
     summary_metrics.to_csv(results_file_path, index=False)
     # wandb.finish()
 
-def set_seed(seed):
+def _seed_worker(rank, args, seeds, main_fn, nprocs, results):
+    # One process per GPU, seeds assigned round-robin; the runs are independent, so nothing is synchronised
+    torch.cuda.set_device(rank)
+    for i in range(rank, len(seeds), nprocs):
+        seed_args = copy.copy(args)
+        # Concurrent runs would otherwise race on the same timestamped results directory
+        seed_args.output_dir = os.path.join(args.output_dir, f"seed_{seeds[i]}")
+        # Lets main split the CPU cores between the runs that actually execute side by side
+        seed_args.concurrent_runs = nprocs
+        set_seed(seeds[i], deterministic=args.deterministic)
+        results[i] = main_fn(seed_args)
+
+def run_seeds_in_parallel(args, seeds, main_fn, num_gpus):
+    nprocs = min(num_gpus, len(seeds))
+    with mp.Manager() as manager:
+        results = manager.dict()
+        mp.spawn(_seed_worker, args=(args, seeds, main_fn, nprocs, results), nprocs=nprocs)
+        return [results[i] for i in range(len(seeds))]
+
+def set_seed(seed, deterministic=False):
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    # Deterministic cuDNN disables the benchmark autotuner, so only opt in when bitwise reproducibility is needed
+    if deterministic:
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
     return seed
 
-def plot_loss_curves(results):
+def plot_loss_curves(results, save_dir="."):
     loss = results["train_loss"]
     test_loss = results["val_loss"]
     accuracy = results["train_acc"]
@@ -88,7 +117,8 @@ def plot_loss_curves(results):
     plt.xlabel("Epochs")
     plt.legend()
     plt.tight_layout()
-    name = f"learning_curve.png"
+    # Saved per run, so parallel seed runs do not overwrite each other's figure
+    name = os.path.join(save_dir, "learning_curve.png")
     plt.savefig(name, bbox_inches='tight')
     # plt.show(block=True)
 
@@ -1,28 +1,42 @@
 import os
+# Set before torch is imported so no allocation can precede it. Growable segments keep reserved memory
+# close to live memory over long runs; override from the environment if needed.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128")
 import argparse
 import torch
+import torch._dynamo
 import torch.nn.functional as F
 from torch.utils.tensorboard import SummaryWriter
 from lib.datasets import get_feature_dataset
 from lib.evaluate_ood import get_ood_metrics
-from lib.utils import get_results_directory, accuracy_fn, repeat_experiment, plot_loss_curves
+from lib.utils import get_results_directory, repeat_experiment, plot_loss_curves
 from lib.evaluate_cp import conformal_evaluate, ConformalTrainingLoss, tps
 # from earlystopping import EarlyStopping
 from torch.utils.data import DataLoader
 import json
 import operator
+from concurrent.futures import ThreadPoolExecutor
 
 from builder_model import build_model
 
 import wandb
 from functools import partial
 
-NUM_WORKERS = os.cpu_count()
+# Checkpoints are written off the training thread; a single worker keeps writes to the same file in order
+_saver = ThreadPoolExecutor(max_workers=1)
 
 # export CUDA_VISIBLE_DEVICES=1
 torch.backends.cudnn.benchmark = True
 
+# Module level so that processes spawned by repeat_experiment see it too; "cuda" follows torch.cuda.set_device
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
 def main(args):
+    # TF32 only for the plain MLP: the SNGP precision/covariance inverse and gpytorch's kernel solves need full fp32
+    use_tf32 = args.snn
+    torch.backends.cuda.matmul.allow_tf32 = use_tf32
+    torch.backends.cudnn.allow_tf32 = use_tf32
+    torch.set_float32_matmul_precision("high" if use_tf32 else "highest")
     results_dir = get_results_directory(args.output_dir)
     print(f"save to results_dir {results_dir}")
 
@@ -46,24 +60,50 @@ def main(args):
     print(f"Training with:\n{args_json}")
 
     model, likelihood, loss_fn = build_model(args=args, num_classes=num_classes, train_dataset=train_dataset)
+    CP_size_fn = ConformalTrainingLoss(alpha=args.alpha, beta=args.beta, temperature=args.temperature, args=args) \
+        if args.conformal_training and args.snipgp else None
+    if args.compile:
+        # Fixed batch size keeps the graphs static; gpytorch's GP layer of SNIPGP is left eager
+        torch._dynamo.config.cache_size_limit = 128
+        compiled_module = model.feature_extractor if args.snipgp else model
+        compiled_module.compile(mode="max-autotune-no-cudagraphs", fullgraph=False, dynamic=False)
+    if args.cuda_graph:
+        # Only the module's forward/backward is captured; the loss and the optimizer step stay eager.
+        # drop_last keeps every training batch at the captured shape, and eval mode falls back to eager.
+        model.train()
+        sample_X = torch.randn(args.batch_size, *train_dataset[0][0].shape, device=device)
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.amp, cache_enabled=False):
+            model = torch.cuda.make_graphed_callables(model, (sample_X,))
     parameters = [ {'params': model.parameters(), 'lr': args.learning_rate} ]
 
     if args.snipgp:
         parameters.append({"params": likelihood.parameters(), 'lr': args.learning_rate})
 
     #######
-    optimizer = torch.optim.AdamW(parameters, weight_decay=args.weight_decay) #For CIFAR10
+    optimizer = torch.optim.AdamW(parameters, weight_decay=args.weight_decay, fused=torch.cuda.is_available()) #For CIFAR10
 
     # optimizer = torch.optim.AdamW(parameters) # For Brain_tumors
 
-    training_steps = len(train_dataset) // args.batch_size * args.epochs
+    # Each of the runs repeat_experiment executes concurrently gets its share of the cores. Of that share,
+    # half goes to the train loader and a sixth to each eval loader, keeping all persistent workers within it.
+    cpus_per_run = max(os.cpu_count() // getattr(args, "concurrent_runs", 1), 1)
+    num_workers, num_eval_workers = max(cpus_per_run // 2, 1), max(cpus_per_run // 6, 1)
+    kwargs = {"pin_memory": True, "persistent_workers": True, "prefetch_factor": 4}
+    if torch.cuda.is_available():
+        kwargs["pin_memory_device"] = "cuda"
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, drop_last=True,
+                              num_workers=num_workers, **kwargs)
+    # No activations are kept for backward during evaluation, so val/test can use much larger batches
+    eval_batch_size = max(args.batch_size * 8, 256)
+    val_loader = DataLoader(val_dataset, batch_size=eval_batch_size, shuffle=False, num_workers=num_eval_workers, **kwargs)
+    test_loader = DataLoader(test_dataset, batch_size=eval_batch_size, shuffle=False, num_workers=num_eval_workers, **kwargs)
+
+    # T_max is counted in optimizer steps, so the scheduler is stepped after every batch in train_step
+    training_steps = len(train_loader) * args.epochs
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=training_steps)
 
     best_inefficiency, best_auroc, best_aupr = float('inf'), float('-inf'), float('-inf')
-
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=NUM_WORKERS, pin_memory=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=NUM_WORKERS, pin_memory=True)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=NUM_WORKERS, pin_memory=True)
+    pending_saves = {}
 
     def simple_transform(args, outputs):
         if args.snipgp:
@@ -71,111 +111,131 @@ def main(args):
             outputs = likelihood(outputs).probs.mean(0)
         return outputs
 
-    def train_step(model, data_loader, loss_fn, optimizer, accuracy_fn, device):
-        train_loss, train_acc = 0, 0
-        model = model.to(device)
+    def train_step(model, data_loader, loss_fn, optimizer, device):
+        train_loss, correct, total = torch.zeros((), device=device), 0, 0
         model.train()
         if args.snipgp and likelihood is not None:
             likelihood.train()
 
         for batch_idx, (X, y) in enumerate(train_loader):
-            X, y = X.to(device), y.to(device)
-            y_pred = model(X)
+            X, y = X.to(device, non_blocking=True), y.to(device, non_blocking=True)
+            # Only the MLP trunk runs in bf16; the classifier/GP heads (see SimpleMLP and DKL) and every loss stay in fp32
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.amp):
+                y_pred = model(X)
             if args.conformal_training and args.snipgp:
-                CP_size_fn = ConformalTrainingLoss(alpha=args.alpha, beta=args.beta,
-                                                   temperature=args.temperature, args=args)
                 loss_cn = loss_fn(y_pred, y)
-                y_temp = y_pred.to_data_independent_dist()
-                y_temp = likelihood(y_temp).probs.mean(0)
-                loss_size = CP_size_fn(y_temp, y)
+                # The predictive probabilities feed both the size loss and the accuracy below
+                prob = simple_transform(args, y_pred)
+                loss_size = CP_size_fn(prob, y)
                 loss = (loss_cn + loss_size)
-                print(f"Total loss: {loss.item():.4f} | ELBO: {loss_cn.item():.4f} | Size loss: {loss_size:.4f}")
             else:
                 loss = loss_fn(y_pred, y)
-
-            train_loss += loss.item()
-            y_pred = simple_transform(args, y_pred)
-            _, y_pred = y_pred.max(1)
-            train_acc += accuracy_fn(y_true=y, y_pred=y_pred)
-            optimizer.zero_grad()
+                prob = simple_transform(args, y_pred)
+
+            train_loss += loss.detach()
+            _, y_pred = prob.max(1)
+            # Kept on device so counting does not force a sync every batch
+            correct += (y_pred == y).sum()
+            total += y.numel()
+            optimizer.zero_grad(set_to_none=True)
             loss.backward()
             optimizer.step()
-        scheduler.step()
-        train_loss /= len(data_loader)
-        train_acc /= len(data_loader)
+            scheduler.step()
+        train_loss = (train_loss / len(data_loader)).item()
+        train_acc = (correct / total).item()
         print(f"Train Loss: {train_loss:.4f} | Train Accuracy: {train_acc:.2f}%")
         return train_loss, train_acc
 
-    def test_step(mode, model, data_loader, accuracy_fn, device):
-        test_loss, test_acc = 0, 0
-        model.to(device)
+    def test_step(mode, model, data_loader, device):
+        test_loss, correct, total = torch.zeros((), device=device), 0, 0
         model.eval()
         if args.snipgp:
             likelihood.eval()
-        prob_list, target_list = [], []
-        with torch.no_grad():
+        # Filled batch by batch, so no per-batch list has to be concatenated afterwards
+        prob, target = None, None
+        num_samples = len(data_loader.dataset)
+        # The SNGP head rewrites its precision matrix through .data on every eval forward; under inference_mode
+        # that would turn the buffer into an inference tensor that load_state_dict can no longer copy into
+        with (torch.no_grad() if args.sngp else torch.inference_mode()):
             for X, y in data_loader:
-                X, y = X.to(device), y.to(device)
+                X, y = X.to(device, non_blocking=True), y.to(device, non_blocking=True)
                 y_pred = model(X)
                 if args.sngp or args.snn:
                     loss = F.cross_entropy(y_pred, y)
                 else:
                     loss = -likelihood.expected_log_prob(y, y_pred).mean()
 
-                test_loss += loss.item()
+                test_loss += loss
                 y_pred = simple_transform(args, y_pred)
 
-                prob_list.append(y_pred)
-                target_list.append(y)
+                if prob is None:
+                    prob = y_pred.new_empty((num_samples, y_pred.size(1)))
+                    target = y.new_empty(num_samples)
+                prob[total:total + len(y)] = y_pred
+                target[total:total + len(y)] = y
                 _, y_pred = y_pred.max(1)
-                test_acc += accuracy_fn(y_true=y, y_pred=y_pred)
-        test_loss /= len(data_loader)
-        test_acc /= len(data_loader)
+                correct += (y_pred == y).sum()
+                total += y.numel()
+        test_loss = (test_loss / len(data_loader)).item()
+        test_acc = (correct / total).item()
 
         print(f"{mode} Loss: {test_loss:.4f} | {mode} accuracy: {test_acc:.2f}%\n")
-
-        prob = torch.cat(prob_list, dim=0)
-        target = torch.cat(target_list, dim=0)
         return test_loss, test_acc, prob, target
+
+    def save_best_metric(metric_name, metric_value, best_metric):
+        compare_fn = operator.gt if metric_name == "auroc" else operator.lt
+        if compare_fn(metric_value, best_metric):
+            best_metric = metric_value
+            # Snapshot on the host now, so later epochs cannot change the weights being written
+            model_state = {
+                'model': {k: v.detach().cpu() for k, v in model.state_dict().items()},
+                 metric_name: best_metric,
+                'likelihood': {k: v.detach().cpu() for k, v in likelihood.state_dict().items()} if args.snipgp else None,
+            }
+            if metric_name in pending_saves:
+                # A write of an older best that has not started yet is superseded by this one
+                pending_saves[metric_name].cancel()
+            pending_saves[metric_name] = _saver.submit(torch.save, model_state, results_dir / f"best_model_{metric_name}.pth")
+            print(f"\nNew best {metric_name}: {best_metric:.4f}, save_path {results_dir / f"best_model_{metric_name}.pth"}")
+        return best_metric
+
     learning_curve = {"train_loss": [], "train_acc": [], "val_loss": [], "val_acc": [] }
     for epoch in range(args.epochs):
         if args.sngp:
             model.classifier.reset_covariance_matrix() # if args.sngp else None
         print(f"\nEpoch: {epoch + 1}/{args.epochs}\n {'-' * 40}")
-        train_loss, train_acc = train_step(model, train_loader, loss_fn, optimizer, accuracy_fn, device)
+        train_loss, train_acc = train_step(model, train_loader, loss_fn, optimizer, device)
         learning_curve["train_loss"].append(train_loss)
         learning_curve["train_acc"].append(train_acc)
-        val_loss, val_acc, val_smx, val_labels = test_step("Validation", model, val_loader, accuracy_fn, device)
+        val_loss, val_acc, val_smx, val_labels = test_step("Validation", model, val_loader, device)
         learning_curve["val_loss"].append(val_loss)
         learning_curve["val_acc"].append(val_acc)
-
-        if not args.snn:
+        writer.add_scalar("train/loss", train_loss, epoch)
+        writer.add_scalar("train/acc", train_acc, epoch)
+        writer.add_scalar("val/loss", val_loss, epoch)
+        writer.add_scalar("val/acc", val_acc, epoch)
+
+        # The OOD pass is the most expensive part of an epoch, so it only runs every eval_every epochs and at the end
+        eval_ood = not args.snn and ((epoch + 1) % args.eval_every == 0 or epoch + 1 == args.epochs)
+        if eval_ood:
             _, auroc, aupr = get_ood_metrics(args.dataset, args.OOD, model, likelihood)
             print(f"Train -- OoD Metrics - AUROC: {auroc:.4f} | AUPR: {aupr:.4f}")
+            writer.add_scalar("ood/auroc", auroc, epoch)
+            writer.add_scalar("ood/aupr", aupr, epoch)
 
         _, coverage, inefficiency = tps(cal_smx=val_smx, val_smx=val_smx, cal_labels=val_labels,
                                         val_labels=val_labels, n=len(val_labels), alpha=args.alpha)
         print(f"Train -- Coverage: {coverage:.4f} | Inefficiency: {inefficiency:.4f}")
+        writer.add_scalar("val/coverage", coverage, epoch)
+        writer.add_scalar("val/inefficiency", inefficiency, epoch)
 
-        def save_best_metric(metric_name, metric_value, best_metric):
-            compare_fn = operator.gt if metric_name == "auroc" else operator.lt
-            if compare_fn(metric_value, best_metric):
-                best_metric = metric_value
-                model_state = {
-                    'model': model.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                     metric_name: best_metric,
-                    'likelihood': likelihood.state_dict() if args.snipgp else None,
-                }
-                torch.save(model_state, results_dir / f"best_model_{metric_name}.pth")
-                print(f"\nNew best {metric_name}: {best_metric:.4f}, save_path {results_dir / f"best_model_{metric_name}.pth"}")
-            return best_metric
-
-        if not args.snn:
+        if eval_ood:
             best_auroc = save_best_metric("auroc", auroc, best_auroc)
         best_inefficiency = save_best_metric("inefficiency", inefficiency, best_inefficiency)
 
     def load_best_state(metric_name, model, likelihood):
+        for future in pending_saves.values():
+            future.result()
         state = torch.load(results_dir / f"best_model_{metric_name}.pth")
         model.load_state_dict(state['model'], strict=False)
         likelihood.load_state_dict(state['likelihood']) if args.snipgp else None
@@ -190,7 +250,7 @@ def main(args):
     likelihood.eval() if args.snipgp else None
 
     result = {}
-    test_loss, test_acc, test_smx, test_labels = test_step("Test", model, test_loader, accuracy_fn, device)
+    test_loss, test_acc, test_smx, test_labels = test_step("Test", model, test_loader, device)
 
     _, coverage, inefficiency = tps(cal_smx=test_smx, val_smx=test_smx, cal_labels=test_labels, val_labels=test_labels, n=len(test_labels), alpha=args.alpha)
     print(f"Test -- Coverage: {coverage:.4f} | Inefficiency: {inefficiency:.4f}")
@@ -218,7 +278,7 @@ def main(args):
     #            "learning_rate":args.learning_rate, "ineff_list":ineff_list, "kernel":args.kernel, "n_inducing_points":args.n_inducing_points})
 
     writer.close()
-    plot_loss_curves(learning_curve)
+    plot_loss_curves(learning_curve, save_dir=results_dir)
     return result
 
 def parse_arguments():
@@ -248,14 +308,23 @@ def parse_arguments():
     parser.add_argument("--size_loss_form", default="log", type=str, help="identity or log")
     parser.add_argument("--spec_norm_replace_list", nargs='+', default=["Linear", "Conv2D"], type=str, help="List of specifications to replace" )
     parser.add_argument("--spectral_normalization", action="store_true", help="Use spectral normalization or not")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile")
+    parser.add_argument("--cuda_graph", action="store_true", help="Replay the SNN forward/backward as a CUDA graph during training")
+    parser.add_argument("--amp", action="store_true", help="Run the training forward pass under bf16 autocast")
+    parser.add_argument("--eval_every", type=int, default=5, help="Compute OOD metrics every N epochs (and at the last epoch)")
+    parser.add_argument("--deterministic", action="store_true", help="Use deterministic cuDNN kernels (disables cudnn.benchmark)")
     args = parser.parse_args()
     if sum([args.sngp, args.snipgp, args.snn]) != 1:
         parser.error("Exactly one of --snn, --sngp or --snipgp must be set.")
+    if args.eval_every < 1:
+        parser.error("--eval_every must be at least 1.")
+    if args.cuda_graph and (not args.snn or args.compile or not torch.cuda.is_available()):
+        # The SNGP head reallocates its precision matrix on every forward and gpytorch is not capturable
+        parser.error("--cuda_graph requires --snn on a CUDA device and cannot be combined with --compile.")
     return args
 
 if __name__ == "__main__":
     args = parse_arguments()
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     seeds = [23]
     #seeds = [1, 23, 42, 202, 2024]
     repeat_experiment(args, seeds, main)